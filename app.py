@@ -1,17 +1,41 @@
 import os
+import gzip
+import hashlib
+import codecs
 import json
 import uuid
 import time
 import logging
 import requests
-from datetime import datetime
-from functools import wraps
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from functools import lru_cache, wraps
 from urllib.parse import urlparse
 import re
 import sys
 import asyncio
+import threading
+import atexit
+import collections
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, make_response, session, abort
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, make_response, session, abort, Response
+
+# JSONシリアライザ（orjsonが利用可能ならC実装を使用）
+try:
+    import orjson
+
+    def json_dumps_bytes(obj):
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+
+    def json_dumps_bytes(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    json_loads = json.loads
 
 # 環境変数を確認
 APP_ENV = os.environ.get('APP_ENV', 'development')
@@ -30,6 +54,9 @@ TEMPLATE_FOLDER = os.path.join(BASE_DIR, 'templates')
 CONFIG_FILE = os.path.join(BASE_DIR, 'config.json') if not os.environ.get('VERCEL') == '1' else '/tmp/config.json'
 URL_LIST_FILE = os.path.join(BASE_DIR, 'url_list.json') if not os.environ.get('VERCEL') == '1' else '/tmp/url_list.json'
 
+# ファイル書き込み時のバッファサイズ
+FILE_WRITE_BUFFER_SIZE = 64 * 1024
+
 # URLsディレクトリを作成（存在しない場合）
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
@@ -142,6 +169,16 @@ try:
                 return None
         return None
         
+    async def kv_read(key):
+        """KVから値を取得し (成功したか, 値) を返す（存在しないキーと取得失敗を区別する）"""
+        if kv:
+            try:
+                return True, await kv.get(key)
+            except Exception as e:
+                app.logger.error(f"KVストレージエラー (get): {str(e)}")
+                return False, None
+        return False, None
+        
     async def kv_set(key, value):
         if kv:
             try:
@@ -160,14 +197,16 @@ try:
                 return False
         return False
         
+    # 非同期関数は常駐するバックグラウンドのイベントループで実行する
+    # （呼び出しのたびにループを取得・生成せず、クライアントの接続も同じループ上で使い回す）
+    _async_loop = asyncio.new_event_loop()
+    threading.Thread(target=_async_loop.run_forever, name='async-loop', daemon=True).start()
+    # 終了時にループを停止する（atexitは登録の逆順に実行されるため、クリック数の書き出しより後になる）
+    atexit.register(_async_loop.call_soon_threadsafe, _async_loop.stop)
+    ASYNC_TIMEOUT = 30  # 1回の非同期処理を待つ最大秒数
+    
     # 非同期関数を実行するヘルパー
     def run_async(coroutine):
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
         # coroutineがNoneの場合やコルーチンでない場合の処理を追加
         if coroutine is None:
             return None
@@ -177,7 +216,13 @@ try:
             return coroutine
         
         try:
-            return loop.run_until_complete(coroutine)
+            future = asyncio.run_coroutine_threadsafe(coroutine, _async_loop)
+            try:
+                return future.result(ASYNC_TIMEOUT)
+            except FutureTimeoutError:
+                # 待機をやめた処理がループ上で走り続けないよう取り消す
+                future.cancel()
+                raise
         except Exception as e:
             app.logger.error(f"coroutine実行中のエラー: {str(e)}")
             return None
@@ -201,6 +246,9 @@ except ImportError as e:
     async def kv_get(key):
         return None
         
+    async def kv_read(key):
+        return False, None
+        
     async def kv_set(key, value):
         return False
         
@@ -225,6 +273,9 @@ except Exception as e:
     async def kv_get(key):
         return None
         
+    async def kv_read(key):
+        return False, None
+        
     async def kv_set(key, value):
         return False
         
@@ -235,37 +286,147 @@ except Exception as e:
         return None
 
 # URLリスト管理
+# URLリストファイルの読み込みキャッシュ（ファイルの更新時刻が変わった時のみ再読み込み）
+_url_list_cache = {'mtime': None, 'data': None, 'by_id': None, 'digest': None}
+# KVから取得したURLリストの短期キャッシュ（連続するリクエストでKVへの問い合わせを省略する）
+URL_LIST_KV_TTL = float(os.environ.get('URL_LIST_KV_TTL', 5))
+_url_list_kv_cache = {'expires': 0.0, 'data': None, 'by_id': None}
+# URLリストの読み込みから保存までを直列化する（作成・削除・クリック数の保存が互いの変更を上書きしないように）
+_url_list_update_lock = threading.RLock()
+
+def _copy_url_list(url_list):
+    """呼び出し側での変更がキャッシュに波及しないようエントリ単位でコピーする"""
+    return [dict(entry) for entry in url_list]
+
+def _index_by_id(url_list):
+    """ID→エントリの索引を作成する"""
+    return {entry.get('id'): entry for entry in url_list}
+
+def _digest(payload):
+    """書き込み内容の比較用ダイジェスト"""
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+def _load_url_list(fresh=False):
+    """URLリストとID索引を読み込む（共有オブジェクトを返すため呼び出し側で変更しないこと）
+    
+    fresh=Trueの場合はKVの短期キャッシュを使わずに取得する（更新して保存する処理用）
+    """
+    # まずVercel KVから取得を試みる
+    if kv:
+        if not fresh and time.monotonic() < _url_list_kv_cache['expires']:
+            return _url_list_kv_cache['data'], _url_list_kv_cache['by_id']
+        ok, url_list = run_async(kv_read('url_list')) or (False, None)
+        if not ok:
+            # 取得に失敗した結果を古いファイルの内容で補うと、保存時にKVへ書き戻されてしまう
+            raise RuntimeError("KVストレージからURLリストを取得できませんでした")
+        # 空のリストもKVの内容として扱う（削除済みのエントリがファイルから復活しないように）
+        if url_list is not None:
+            app.logger.info("KVストレージからURLリストを取得しました")
+            by_id = _index_by_id(url_list)
+            _url_list_kv_cache.update(data=url_list, by_id=by_id,
+                                      expires=time.monotonic() + URL_LIST_KV_TTL)
+            return url_list, by_id
+    
+    # KVにまだ保存されていない場合はファイルから読み込む
+    try:
+        try:
+            mtime = os.stat(URL_LIST_FILE).st_mtime_ns
+        except FileNotFoundError:
+            app.logger.warning(f"URLリストファイルが存在しません: {URL_LIST_FILE}")
+            return [], {}
+        
+        if mtime != _url_list_cache['mtime']:
+            with open(URL_LIST_FILE, 'rb') as f:
+                raw = f.read()
+            url_list = json_loads(raw)
+            _url_list_cache.update(data=url_list, by_id=_index_by_id(url_list), mtime=mtime, digest=_digest(raw))
+            app.logger.info(f"ファイルからURLリストを取得しました: {URL_LIST_FILE}")
+        return _url_list_cache['data'], _url_list_cache['by_id']
+    except Exception as e:
+        app.logger.error(f"URLリストファイル読み込みエラー: {str(e)}")
+        return [], {}
+
 def get_url_list():
     """保存されたURLリストを取得 (Vercel KV & 後方互換性)"""
     try:
-        # まずVercel KVから取得を試みる
-        if kv:
-            try:
-                url_list = run_async(kv_get('url_list'))
-                if url_list:
-                    app.logger.info("KVストレージからURLリストを取得しました")
-                    return url_list
-            except Exception as e:
-                app.logger.error(f"KVストレージからのURLリスト取得エラー: {str(e)}")
-        
-        # KVに接続できない場合はファイルから読み込む
-        try:
-            if os.path.exists(URL_LIST_FILE):
-                with open(URL_LIST_FILE, 'r') as f:
-                    url_list = json.load(f)
-                    app.logger.info(f"ファイルからURLリストを取得しました: {URL_LIST_FILE}")
-                    return url_list
-            else:
-                app.logger.warning(f"URLリストファイルが存在しません: {URL_LIST_FILE}")
-                return []
-        except Exception as e:
-            app.logger.error(f"URLリストファイル読み込みエラー: {str(e)}")
-            return []
+        url_list, _ = _load_url_list()
+        return _copy_url_list(url_list)
     except Exception as e:
         app.logger.error(f"URLリスト取得エラー: {str(e)}")
         # エラーが発生した場合は空のリストを返す
         return []
 
+def get_url_list_for_update():
+    """更新して保存するためにURLリストを取得する（取得に失敗した場合は例外を送出する）"""
+    url_list, _ = _load_url_list(fresh=True)
+    return _copy_url_list(url_list)
+
+# URLエントリはKVにも個別のキーで保存し、表示時はリスト全体を取得せずに参照する
+def url_entry_key(file_id):
+    """URLエントリを個別に保存するKVキー"""
+    return f"url:{file_id}"
+
+async def delete_stored_content(file_id, blob_url):
+    """URLエントリの個別キーとBlobのコンテンツを並行して削除する"""
+    tasks = []
+    if kv:
+        tasks.append(kv_delete(url_entry_key(file_id)))
+    if blob_url:
+        tasks.append(blob_delete(blob_url))
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+def delete_stored_content_sync(file_id, blob_url):
+    """delete_stored_contentを実行し、失敗した操作をログに記録する"""
+    if blob_url:
+        _blob_html_cache.pop(blob_url, None)
+    try:
+        results = run_async(delete_stored_content(file_id, blob_url)) or []
+    except Exception as e:
+        app.logger.error(f"保存済みコンテンツの削除に失敗: {str(e)}")
+        return
+    for result in results:
+        if isinstance(result, Exception):
+            app.logger.error(f"保存済みコンテンツの削除に失敗: {str(result)}")
+
+async def save_entry_and_evict(url_entry, oldest_entry):
+    """新しいエントリの個別キーの保存と古いエントリのコンテンツ削除を並行して行う"""
+    tasks = []
+    if kv:
+        tasks.append(kv_set(url_entry_key(url_entry['id']), url_entry))
+    if oldest_entry is not None:
+        tasks.append(delete_stored_content(oldest_entry['id'], oldest_entry.get('blob_url')))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # 削除側の結果は操作ごとのリストなので平坦にする
+    flattened = []
+    for result in results:
+        flattened.extend(result if isinstance(result, list) else [result])
+    return flattened
+
+def save_entry_and_evict_sync(url_entry, oldest_entry):
+    """save_entry_and_evictを実行し、失敗した操作をログに記録する"""
+    if oldest_entry is not None and oldest_entry.get('blob_url'):
+        _blob_html_cache.pop(oldest_entry['blob_url'], None)
+    for result in run_async(save_entry_and_evict(url_entry, oldest_entry)) or []:
+        if isinstance(result, Exception):
+            app.logger.error(f"URLエントリの保存または古いコンテンツの削除に失敗: {str(result)}")
+
+def get_url_entry(file_id):
+    """IDに対応するURLエントリを取得する（存在しない場合はNone）"""
+    try:
+        # KVのURLリストの短期キャッシュが切れている場合は、個別のキーを一件だけ取得する
+        if kv and time.monotonic() >= _url_list_kv_cache['expires']:
+            entry = run_async(kv_get(url_entry_key(file_id)))
+            if entry:
+                return dict(entry)
+        
+        # 個別のキーがない（以前に作成された）エントリはURLリストの索引から探す
+        _, by_id = _load_url_list()
+        entry = by_id.get(file_id)
+        return dict(entry) if entry else None
+    except Exception as e:
+        app.logger.error(f"URLエントリ取得エラー: {str(e)}")
+        return None
+
 def save_url_list(url_list):
     """URLリストを保存 (Vercel KV & 後方互換性)"""
     try:
@@ -277,15 +438,38 @@ def save_url_list(url_list):
                 kv_result = run_async(kv_set('url_list', url_list))
                 if kv_result:
                     app.logger.info("URLリストをKVストレージに保存しました")
+                    # 保存した内容で短期キャッシュも更新する
+                    cached_list = _copy_url_list(url_list)
+                    _url_list_kv_cache.update(data=cached_list, by_id=_index_by_id(cached_list),
+                                              expires=time.monotonic() + URL_LIST_KV_TTL)
             except Exception as e:
                 app.logger.error(f"KVストレージへのURLリスト保存エラー: {str(e)}")
         
-        # ファイルにも保存（後方互換性）
+        # KVが使えない場合はファイルに保存（後方互換性）
         file_saved = False
         try:
-            with open(URL_LIST_FILE, 'w') as f:
-                json.dump(url_list, f)
-            app.logger.info(f"URLリストをファイルに保存しました: {URL_LIST_FILE}")
+            # 一括でシリアライズしてから一度に書き込む
+            payload = json_dumps_bytes(url_list)
+            digest = _digest(payload)
+            try:
+                unchanged = (digest == _url_list_cache['digest']
+                             and os.stat(URL_LIST_FILE).st_mtime_ns == _url_list_cache['mtime'])
+            except FileNotFoundError:
+                unchanged = False
+            
+            # ファイルの内容と同じであれば書き込みを省略する
+            if not unchanged:
+                with open(URL_LIST_FILE, 'wb', buffering=FILE_WRITE_BUFFER_SIZE) as f:
+                    f.write(payload)
+                app.logger.info(f"URLリストをファイルに保存しました: {URL_LIST_FILE}")
+                # 書き込んだ内容でキャッシュを更新（次回の再読み込みを省略）
+                cached_list = _copy_url_list(url_list)
+                _url_list_cache.update(
+                    data=cached_list,
+                    by_id=_index_by_id(cached_list),
+                    mtime=os.stat(URL_LIST_FILE).st_mtime_ns,
+                    digest=digest,
+                )
             file_saved = True
         except Exception as e:
             # Vercel環境ではファイル書き込みエラーは許容
@@ -303,6 +487,24 @@ def save_url_list(url_list):
         return False
 
 # 設定管理
+# 設定ファイルの読み込みキャッシュ（ファイルの更新時刻が変わった時のみ再読み込み）
+_config_file_cache = {'mtime': None, 'data': {}}
+_config_lock = threading.RLock()
+
+def _load_config_file():
+    """設定ファイルの内容を読み込む（共有オブジェクトを返すため呼び出し側で変更しないこと）"""
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    
+    with _config_lock:
+        if mtime != _config_file_cache['mtime']:
+            with open(CONFIG_FILE, 'rb') as f:
+                data = json_loads(f.read())
+            _config_file_cache.update(data=data, mtime=mtime)
+        return _config_file_cache['data']
+
 def get_config():
     """アプリケーション設定を取得"""
     try:
@@ -315,14 +517,12 @@ def get_config():
             'admin_password': os.environ.get('ADMIN_PASSWORD', 'admin'),
         }
         
-        # 設定ファイルが存在する場合は読み込み
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                file_config = json.load(f)
-                # 環境変数で明示的に設定されていない場合のみファイルの設定を使用
-                for key, value in file_config.items():
-                    if key not in os.environ:
-                        config[key] = value
+        # 設定ファイルが存在する場合は読み込み（更新されていなければキャッシュを使用）
+        file_config = _load_config_file()
+        # 環境変数で明示的に設定されていない場合のみファイルの設定を使用
+        for key, value in file_config.items():
+            if key not in os.environ:
+                config[key] = value
         
         return config
     except Exception as e:
@@ -339,54 +539,465 @@ def get_config():
 def update_config(new_config):
     """アプリケーション設定を更新"""
     try:
-        # 現在の設定を取得
-        current_config = get_config()
-        # 新しい設定で更新
-        current_config.update(new_config)
-        
-        # 設定ファイルに保存
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(current_config, f)
+        # 読み込みから保存までの間に他のスレッドの更新が割り込まないようにする
+        with _config_lock:
+            # 現在の設定を取得
+            current_config = get_config()
+            # 新しい設定で更新
+            current_config.update(new_config)
+            
+            # 設定ファイルに保存
+            with open(CONFIG_FILE, 'wb') as f:
+                f.write(json_dumps_bytes(current_config))
+            
+            # 書き込んだ内容でキャッシュを更新（次回の再読み込みを省略）
+            _config_file_cache.update(data=current_config, mtime=os.stat(CONFIG_FILE).st_mtime_ns)
             
         return True
     except Exception as e:
         app.logger.error(f"設定更新エラー: {str(e)}")
         return False
 
+# 日時文字列の生成
+# 同じ秒の間は整形済みの文字列を使い回す（(秒, 文字列) の組で保持し、スレッド間で不整合が出ないようにする）
+_now_str_cache = (None, '')
+
+def now_str():
+    """現在日時を 'YYYY-MM-DD HH:MM:SS' 形式で返す（strftimeを経由しない）"""
+    global _now_str_cache
+    second = int(time.time())
+    cached_second, text = _now_str_cache
+    if second != cached_second:
+        t = time.localtime(second)
+        text = f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}"
+        _now_str_cache = (second, text)
+    return text
+
+# TikTok Pixelスクリプトのテンプレート（モジュール読み込み時に一度だけ構築）
+# 改行とインデントは読み込み時に取り除き、保存するHTMLを小さくする
+# ピクセルIDはformatではなく目印の文字列を置換して埋め込む（JSの波括弧をエスケープせずに済む）
+PIXEL_ID_PLACEHOLDER = '__PIXEL_ID__'
+TIKTOK_PIXEL_TEMPLATE = ''.join(line.strip() for line in """
+<script>
+!function (w, d, t) {
+  w.TiktokAnalyticsObject=t;var ttq=w[t]=w[t]||[];ttq.methods=["page","track","identify","instances","debug","on","off","once","ready","alias","group","enableCookie","disableCookie"],ttq.setAndDefer=function(t,e){t[e]=function(){t.push([e].concat(Array.prototype.slice.call(arguments,0)))}}; for(var i=0;i<ttq.methods.length;i++)ttq.setAndDefer(ttq,ttq.methods[i]);ttq.instance=function(t){for(var e=ttq._i[t]||[],n=0;n<ttq.methods.length;n++)ttq.setAndDefer(e,ttq.methods[n]);return e},ttq.load=function(e,n){var i="https://analytics.tiktok.com/i18n/pixel/events.js";ttq._i=ttq._i||{},ttq._i[e]=[],ttq._i[e]._u=i,ttq._t=ttq._t||{},ttq._t[e]=+new Date,ttq._o=ttq._o||{},ttq._o[e]=n||{};var o=document.createElement("script");o.type="text/javascript",o.async=!0,o.src=i+"?sdkid="+e+"&lib="+t;var a=document.getElementsByTagName("script")[0];a.parentNode.insertBefore(o,a)};
+  ttq.load('__PIXEL_ID__');
+  ttq.page();
+}(window, document, 'ttq');
+</script>
+""".splitlines())
+
+# ピクセルIDの抽出・正規化
+PIXEL_ID_IN_SCRIPT_RE = re.compile(r'ttq\.load\([\'"]([A-Z0-9]+)[\'"]')
+PIXEL_ID_SANITIZE_RE = re.compile(r'[^A-Z0-9]')
+
 # TikTok Pixelスクリプト生成
+@lru_cache(maxsize=32)
 def generate_tiktok_pixel_script(pixel_id_or_code):
-    """TikTok Pixelスクリプトを生成する"""
+    """TikTok Pixelスクリプトを生成する（ピクセルIDごとに結果をキャッシュ）"""
     if pixel_id_or_code.startswith('<script'):
         # 既にスクリプトタグの場合はそのまま返す
         return pixel_id_or_code
     else:
         # IDの場合は標準的なスクリプトを生成
         pixel_id = pixel_id_or_code.strip()
-        return f"""
-<script>
-!function (w, d, t) {{
-  w.TiktokAnalyticsObject=t;var ttq=w[t]=w[t]||[];ttq.methods=["page","track","identify","instances","debug","on","off","once","ready","alias","group","enableCookie","disableCookie"],ttq.setAndDefer=function(t,e){{t[e]=function(){{t.push([e].concat(Array.prototype.slice.call(arguments,0)))}}}}; for(var i=0;i<ttq.methods.length;i++)ttq.setAndDefer(ttq,ttq.methods[i]);ttq.instance=function(t){{for(var e=ttq._i[t]||[],n=0;n<ttq.methods.length;n++)ttq.setAndDefer(e,ttq.methods[n]);return e}},ttq.load=function(e,n){{var i="https://analytics.tiktok.com/i18n/pixel/events.js";ttq._i=ttq._i||{{}},ttq._i[e]=[],ttq._i[e]._u=i,ttq._t=ttq._t||{{}},ttq._t[e]=+new Date,ttq._o=ttq._o||{{}},ttq._o[e]=n||{{}};var o=document.createElement("script");o.type="text/javascript",o.async=!0,o.src=i+"?sdkid="+e+"&lib="+t;var a=document.getElementsByTagName("script")[0];a.parentNode.insertBefore(o,a)}};
-  ttq.load('{pixel_id}');
-  ttq.page();
-}}(window, document, 'ttq');
-</script>
-"""
+        return TIKTOK_PIXEL_TEMPLATE.replace(PIXEL_ID_PLACEHOLDER, pixel_id)
+
+# ピクセルコードの挿入
+HEAD_END_RE = re.compile(r'</head\s*>', re.IGNORECASE)
+BODY_START_RE = re.compile(r'<body(?:\s[^>]*)?>', re.IGNORECASE)
+
+def insert_pixel_script(html_content, pixel_script):
+    """</head> の直前にピクセルコードを挿入する（HTMLの走査は一度だけ）"""
+    match = HEAD_END_RE.search(html_content)
+    if match:
+        insert_index = match.start()
+    else:
+        # </head>がない場合は<body>タグの直後に挿入
+        match = BODY_START_RE.search(html_content)
+        if not match:
+            # どちらもない場合は先頭に挿入
+            return pixel_script + html_content
+        insert_index = match.end()
+    return ''.join((html_content[:insert_index], pixel_script, html_content[insert_index:]))
 
 # クリック数の更新
+# リクエスト中はメモリ上で集計し、一定間隔でまとめてURLリストに保存する（0の場合は都度保存）
+CLICK_FLUSH_INTERVAL = float(os.environ.get('CLICK_FLUSH_INTERVAL', 10))
+# 間隔を待たずに保存する未保存クリック数（0の場合は件数では保存しない）
+CLICK_FLUSH_THRESHOLD = int(os.environ.get('CLICK_FLUSH_THRESHOLD', 50))
+_pending_clicks = collections.Counter()
+_pending_last_clicked = {}
+_pending_click_total = 0
+_click_lock = threading.Lock()
+_click_flush_timer = None
+# 保存が依頼済みまたは実行中かどうか（件数による保存を重複して依頼しないため）
+_click_flush_active = False
+
+def _start_click_flush_timer():
+    """保存用のタイマーが待機中でなければ開始する（_click_lockを保持して呼ぶこと）"""
+    global _click_flush_timer
+    if CLICK_FLUSH_INTERVAL > 0 and _click_flush_timer is None:
+        _click_flush_timer = threading.Timer(CLICK_FLUSH_INTERVAL, flush_click_counts)
+        _click_flush_timer.daemon = True
+        _click_flush_timer.start()
+
+def _requeue_clicks(clicks, last_clicked):
+    """保存できなかったクリック数を次回の保存に持ち越す"""
+    global _pending_click_total
+    with _click_lock:
+        _pending_clicks.update(clicks)
+        for file_id, clicked_at in last_clicked.items():
+            _pending_last_clicked.setdefault(file_id, clicked_at)
+        _pending_click_total += sum(clicks.values())
+        _start_click_flush_timer()
+
 def update_click_count(file_id):
-    """URLのクリック数を更新する"""
+    """URLのクリック数を加算する（保存はflush_click_countsでまとめて行う）"""
+    global _pending_click_total, _click_flush_active
+    with _click_lock:
+        _pending_clicks[file_id] += 1
+        _pending_last_clicked[file_id] = now_str()
+        _pending_click_total += 1
+        # 上限に達した時点で保存が依頼済みでも実行中でもなければ、一回だけ依頼する
+        # （持ち越したクリック数で上限を超えている場合も含む）
+        threshold_reached = (CLICK_FLUSH_THRESHOLD > 0 and not _click_flush_active
+                             and _pending_click_total >= CLICK_FLUSH_THRESHOLD)
+        if threshold_reached:
+            _click_flush_active = True
+        else:
+            _start_click_flush_timer()
+    
+    if CLICK_FLUSH_INTERVAL <= 0:
+        flush_click_counts()
+    elif threshold_reached:
+        # 件数が上限に達した場合は、表示を待たせないようバックグラウンドで保存する
+        background_executor.submit(flush_click_counts)
+
+def flush_click_counts():
+    """集計中のクリック数をURLリストに反映して保存する"""
+    global _click_flush_timer, _pending_click_total, _click_flush_active
+    with _click_lock:
+        _click_flush_active = True
+        clicks = dict(_pending_clicks)
+        last_clicked = dict(_pending_last_clicked)
+        _pending_clicks.clear()
+        _pending_last_clicked.clear()
+        _pending_click_total = 0
+        # 件数による保存の場合は、待機中のタイマーを止める
+        if _click_flush_timer is not None:
+            _click_flush_timer.cancel()
+        _click_flush_timer = None
+    
     try:
-        url_list = get_url_list()
-        for url in url_list:
-            if url.get('id') == file_id:
-                if 'clicks' not in url:
-                    url['clicks'] = 0
-                url['clicks'] += 1
-                url['last_clicked'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                save_url_list(url_list)
-                break
+        if clicks:
+            _save_click_counts(clicks, last_clicked)
+    finally:
+        with _click_lock:
+            _click_flush_active = False
+
+def _save_click_counts(clicks, last_clicked):
+    """取り出したクリック数をURLリストに保存する（失敗した場合は持ち越す）"""
+    try:
+        with _url_list_update_lock:
+            url_list = get_url_list_for_update()
+            for url in url_list:
+                file_id = url.get('id')
+                if file_id in clicks:
+                    url['clicks'] = url.get('clicks', 0) + clicks[file_id]
+                    url['last_clicked'] = last_clicked[file_id]
+            saved = save_url_list(url_list)
     except Exception as e:
         app.logger.error(f"クリック数更新エラー: {str(e)}")
+        saved = False
+    
+    if not saved:
+        # URLリストを取得・保存できなかった分は次回の保存に持ち越す
+        app.logger.error("クリック数を保存できなかったため次回に持ち越します")
+        _requeue_clicks(clicks, last_clicked)
+
+# 終了時に未保存のクリック数を書き出す
+atexit.register(flush_click_counts)
+
+def record_click(file_id):
+    """クリック数を加算する（失敗しても表示は継続する）"""
+    try:
+        update_click_count(file_id)
+    except Exception as e:
+        app.logger.error(f"クリック数更新エラー: {str(e)}")
+
+# 表示ページのCDNキャッシュ（0の場合は無効）
+# 有効時に作成したページはCDNが応答したアクセスも数えられるよう、埋め込んだビーコンでクリック数を加算する
+# （ビーコンの有無はエントリのclick_via_beaconに記録し、設定を変更しても二重計上や計上漏れがないようにする）
+VIEW_CDN_MAX_AGE = int(os.environ.get('VIEW_CDN_MAX_AGE', 0))
+VIEW_CDN_STALE_WHILE_REVALIDATE = int(os.environ.get('VIEW_CDN_STALE_WHILE_REVALIDATE', 604800))
+CLICK_BEACON_TEMPLATE = '<script>navigator.sendBeacon&&navigator.sendBeacon("/click/{file_id}")</script>'
+
+def set_view_cache_headers(response, etag, last_modified, click_via_beacon=False):
+    """表示ページのレスポンスに検証子とキャッシュ指示を設定する（CDNで共有キャッシュするのはビーコン付きのページのみ）"""
+    # 条件付きGETに対応（変更がなければ304を返す）
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if click_via_beacon and VIEW_CDN_MAX_AGE > 0:
+        # CDNで共有キャッシュし、期限切れ後も再検証の間は古い内容を返させる
+        response.headers['Cache-Control'] = (
+            f"public, max-age=0, s-maxage={VIEW_CDN_MAX_AGE}, "
+            f"stale-while-revalidate={VIEW_CDN_STALE_WHILE_REVALIDATE}"
+        )
+    else:
+        # クリック数を数えるため、キャッシュは毎回再検証させる
+        response.cache_control.no_cache = True
+
+# 件数上限付きキャッシュ
+def cache_put(cache, lock, key, value, max_size):
+    """件数上限付きのキャッシュに登録する（上限に達したら最も古く登録されたものから破棄）"""
+    with lock:
+        cache.pop(key, None)
+        if len(cache) >= max_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+
+# HTMLのデコード
+FALLBACK_ENCODINGS = ['shift_jis', 'euc-jp', 'cp932', 'iso-2022-jp']
+# コーデックの検索は起動時に一度だけ行う
+FALLBACK_DECODERS = [(encoding, codecs.lookup(encoding).decode) for encoding in FALLBACK_ENCODINGS]
+
+def decode_html_bytes(raw_content):
+    """バイト列のHTMLを文字列にデコードする（UTF-8優先、次に文字コードを推定）"""
+    try:
+        return raw_content.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    
+    # 文字コードを一度の走査で推定（UTF-8以外のページでのみ必要なため、ここで読み込む）
+    from charset_normalizer import from_bytes
+    best = from_bytes(raw_content).best()
+    if best is not None:
+        app.logger.info(f"エンコーディング検出: {best.encoding}")
+        return str(best)
+    
+    # 推定できなかった場合は日本語の代表的なエンコーディングを順に試す
+    for encoding, decode in FALLBACK_DECODERS:
+        try:
+            html_content, _ = decode(raw_content)
+            app.logger.info(f"エンコーディング検出: {encoding}")
+            return html_content
+        except UnicodeDecodeError:
+            continue
+    
+    # どのエンコーディングでも読み込めなかった場合
+    app.logger.warning("不明なエンコーディング、置換モードで読み込み")
+    return raw_content.decode('utf-8', errors='replace')
+
+@lru_cache(maxsize=128)
+def load_html_file(file_path, mtime_ns):
+    """保存済みHTMLファイルを読み込み、UTF-8のバイト列で返す（パスと更新時刻の組ごとにキャッシュ）"""
+    with open(file_path, 'rb') as f:
+        raw_content = f.read()
+    try:
+        # 保存時にUTF-8で書き出しているため、通常はそのまま返せる
+        raw_content.decode('utf-8')
+        return raw_content
+    except UnicodeDecodeError:
+        return decode_html_bytes(raw_content).encode('utf-8')
+
+# これより大きい保存済みHTMLはメモリに載せず、チャンク単位でストリーミング配信する
+STREAM_MIN_SIZE = 1024 * 1024  # 1MB
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def iter_file_chunks(file_path):
+    """ファイルをチャンク単位で読み出すジェネレータ"""
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+# Blobに保存したHTMLのキャッシュ（Blobは作成後に書き換えないためURLごとに保持）
+BLOB_CACHE_SIZE = 32
+# Trueの場合、Blobに保存したページは本文を中継せずBlobのURLへリダイレクトして配信する
+SERVE_BLOB_VIA_REDIRECT = os.environ.get('SERVE_BLOB_VIA_REDIRECT', 'False').lower() == 'true'
+_blob_html_cache = {}
+_blob_html_cache_lock = threading.Lock()
+
+def get_blob_html(blob_url):
+    """BlobストレージからHTMLを取得し、UTF-8のバイト列で返す（取得済みならキャッシュを使用）"""
+    html_content = _blob_html_cache.get(blob_url)
+    if html_content is not None:
+        return html_content
+    
+    coroutine = blob_get(blob_url)
+    if not asyncio.iscoroutine(coroutine):
+        app.logger.error("blob_getがコルーチンを返しませんでした")
+        return None
+    
+    html_content = run_async(coroutine)
+    if not html_content:
+        return None
+    # 応答のたびにエンコードしないよう、エンコード済みのバイト列を保持する
+    html_bytes = html_content.encode('utf-8')
+    cache_put(_blob_html_cache, _blob_html_cache_lock, blob_url, html_bytes, BLOB_CACHE_SIZE)
+    return html_bytes
+
+# 外部ページの取得
+FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+}
+FETCH_CHUNK_SIZE = 64 * 1024
+MAX_FETCH_BYTES = 8 * 1024 * 1024  # 8MB制限
+
+# 外部ページ取得用のセッション（同じオリジンへの接続を再利用する）
+http_session = requests.Session()
+http_session.headers.update(FETCH_HEADERS)
+# 接続プールの上限と、一時的な上流エラー(502/503/504)の再試行を設定
+_fetch_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                      allowed_methods=['GET'], raise_on_status=False),
+)
+http_session.mount('http://', _fetch_adapter)
+http_session.mount('https://', _fetch_adapter)
+
+# 外部ページの取得と並行して行うI/O（URLリストの読み込みなど）用のスレッドプール
+background_executor = ThreadPoolExecutor(max_workers=4)
+
+# 検証子(ETag/Last-Modified)付きで取得したページのキャッシュ（条件付きGETに使用）
+FETCH_CACHE_SIZE = 8
+_fetch_cache = {}
+_fetch_cache_lock = threading.Lock()
+
+# 同じURLを同時に取得しようとした場合は、先行するリクエストの結果を共有する
+FETCH_INFLIGHT_WAIT = 30  # 先行リクエストの完了を待つ最大秒数
+_fetch_inflight = {}
+_fetch_inflight_lock = threading.Lock()
+
+def fetch_html_content(url):
+    """URLからHTMLを取得する（同じURLへの同時取得は一度にまとめる）"""
+    with _fetch_inflight_lock:
+        call = _fetch_inflight.get(url)
+        is_leader = call is None
+        if is_leader:
+            call = {'event': threading.Event(), 'result': None, 'error': None}
+            _fetch_inflight[url] = call
+    
+    if not is_leader:
+        if call['event'].wait(FETCH_INFLIGHT_WAIT):
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        # 待ちきれない場合は自分で取得する
+        return _fetch_html_content(url)
+    
+    try:
+        call['result'] = _fetch_html_content(url)
+        return call['result']
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        with _fetch_inflight_lock:
+            _fetch_inflight.pop(url, None)
+        call['event'].set()
+
+def _fetch_html_content(url):
+    """URLからHTMLを取得する（ストリーミングで読み込み、上限サイズを超えた場合は中断）"""
+    headers = {}
+    cached = _fetch_cache.get(url)
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    with http_session.get(url, headers=headers, timeout=10, stream=True) as response:
+        if response.status_code == 304 and cached:
+            app.logger.info(f"ページが更新されていないためキャッシュを使用: {url}")
+            return cached['html']
+        response.raise_for_status()
+        
+        buf = bytearray()
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            buf.extend(chunk)
+            if len(buf) > MAX_FETCH_BYTES:
+                raise ValueError(f"ページサイズが上限({MAX_FETCH_BYTES // (1024 * 1024)}MB)を超えています")
+        
+        raw_content = bytes(buf)
+        # charsetが明示されている場合のみ信頼する
+        # （requestsはcharset未指定のtext/*にISO-8859-1を仮定するため、その場合は判定に回す）
+        content_type = response.headers.get('Content-Type', '').lower()
+        if not response.encoding or 'charset=' not in content_type:
+            html_content = decode_html_bytes(raw_content)
+        else:
+            try:
+                html_content = raw_content.decode(response.encoding, errors='replace')
+            except LookupError:
+                # 不明なエンコーディング名が指定されていた場合
+                html_content = raw_content.decode('utf-8', errors='replace')
+        
+        # 検証子があれば次回の条件付きGET用に保持
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            cache_put(_fetch_cache, _fetch_cache_lock, url,
+                      {'etag': etag, 'last_modified': last_modified, 'html': html_content},
+                      FETCH_CACHE_SIZE)
+        
+        return html_content
+
+# レスポンス圧縮
+GZIP_MIN_SIZE = 1024  # これより小さいレスポンスは圧縮しない
+GZIP_CACHE_SIZE = 128  # 圧縮済みレスポンスを保持する件数
+
+# 圧縮済みレスポンスのキャッシュ（同じ内容を繰り返し圧縮しない）
+_gzip_cache = {}
+_gzip_cache_lock = threading.Lock()
+
+def compress_response(response, cache_key=None):
+    """クライアントがgzipに対応していればレスポンスを圧縮する
+
+    cache_keyを指定した場合、圧縮結果をキーごとに保持して再利用する。
+    キーは内容が変わると変わる値（ETagなど）でなければならない。
+    """
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+    
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    
+    compressed = _gzip_cache.get(cache_key) if cache_key is not None else None
+    if compressed is None:
+        compressed = gzip.compress(data, compresslevel=6)
+        if cache_key is not None:
+            cache_put(_gzip_cache, _gzip_cache_lock, cache_key, compressed, GZIP_CACHE_SIZE)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.after_request
+def compress_html_response(response):
+    """管理画面やエラーページなど、未圧縮のHTMLレスポンスもgzip圧縮する"""
+    if (response.mimetype == 'text/html'
+            and not response.is_streamed
+            and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers):
+        return compress_response(response)
+    return response
+
+# エラーページ
+@lru_cache(maxsize=32)
+def render_error_page(error):
+    """エラーページを描画する（固定メッセージごとに一度だけ描画してキャッシュ）"""
+    return render_template('error.html', error=error)
+
+def error_response(error, status_code):
+    """固定メッセージのエラーレスポンスを返す"""
+    return make_response(render_error_page(error), status_code)
 
 # ルーティング
 @app.route('/')
@@ -411,50 +1022,44 @@ def create():
         if not url.startswith(('http://', 'https://')):
             url = 'https://' + url
         
+        config = get_config()
+        
         # ピクセルコードからIDを抽出または既存のスクリプトをそのまま使用
         if pixel_code and '<script' in pixel_code:
             # 完全なスクリプトの場合
             pixel_script = pixel_code
             # IDを抽出（ベストエフォート）
-            match = re.search(r'ttq\.load\([\'"]([A-Z0-9]+)[\'"]', pixel_code)
+            match = PIXEL_ID_IN_SCRIPT_RE.search(pixel_code)
             tiktok_pixel_id = match.group(1) if match else "カスタムコード"
         elif pixel_code:
             # IDのみの場合
-            tiktok_pixel_id = re.sub(r'[^A-Z0-9]', '', pixel_code.upper())
+            tiktok_pixel_id = PIXEL_ID_SANITIZE_RE.sub('', pixel_code.upper())
             pixel_script = generate_tiktok_pixel_script(tiktok_pixel_id)
         else:
             # デフォルト設定を使用
-            config = get_config()
             tiktok_pixel_id = config.get('pixel_id', 'CM0EQKBC77U7DDDCEF4G')
             pixel_script = generate_tiktok_pixel_script(tiktok_pixel_id)
         
         # URLからHTMLコンテンツを取得
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            }
-            response = requests.get(url, headers=headers, timeout=10)
-            response.raise_for_status()
-            html_content = response.text
-        except requests.exceptions.RequestException as e:
+            html_content = fetch_html_content(url)
+        except (requests.exceptions.RequestException, ValueError) as e:
             app.logger.error(f"URLからのコンテンツ取得に失敗: {str(e)}")
             flash(f'URLからのコンテンツ取得に失敗しました: {str(e)}', 'error')
             return redirect(url_for('index'))
         
-        # HTMLにピクセルコードを挿入
-        head_closing_tag = '</head>'
-        if head_closing_tag in html_content:
-            # </head> の直前にピクセルコードを挿入
-            head_end_index = html_content.find(head_closing_tag)
-            new_html = html_content[:head_end_index] + pixel_script + html_content[head_end_index:]
-        else:
-            # <head>タグがない場合は先頭に挿入
-            new_html = pixel_script + html_content
-        
         # 一意のファイル名を生成
         file_id = str(uuid.uuid4())
         file_name = f"{file_id}.html"
         
+        # CDNキャッシュ有効時はクリック計測用のビーコンも埋め込む
+        click_via_beacon = VIEW_CDN_MAX_AGE > 0
+        if click_via_beacon:
+            pixel_script = pixel_script + CLICK_BEACON_TEMPLATE.format(file_id=file_id)
+        
+        # HTMLにピクセルコードを挿入
+        new_html = insert_pixel_script(html_content, pixel_script)
+        
         # Vercel Blobにコンテンツを保存
         blob_url = None
         try:
@@ -501,17 +1106,15 @@ def create():
             # ローカル環境の場合はファイルに保存
             file_path = os.path.join(UPLOAD_FOLDER, file_name)
             try:
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(new_html)
+                payload = new_html.encode('utf-8')
+                with open(file_path, 'wb', buffering=FILE_WRITE_BUFFER_SIZE) as f:
+                    f.write(payload)
                 app.logger.warning("Blobストレージが使用できないため、ファイルに保存しました")
             except Exception as e:
                 app.logger.error(f"ファイル保存エラー: {str(e)}")
                 flash(f'ファイル保存エラー: {str(e)}', 'error')
                 return redirect(url_for('index'))
         
-        # URLリストに追加
-        url_list = get_url_list()
-        
         # 本番環境のURLを取得
         if os.environ.get('VERCEL_URL'):
             base_url = f"https://{os.environ.get('VERCEL_URL')}"
@@ -521,26 +1124,6 @@ def create():
         new_url = f"/view/{file_id}"
         full_url = f"{base_url}{new_url}"
         
-        # 古いエントリの削除（上限を超える場合）
-        config = get_config()
-        max_urls = config.get('max_urls', 100)
-        if len(url_list) >= max_urls:
-            # 作成日時でソートして古いものから削除
-            url_list.sort(key=lambda x: x.get('created_at', ''))
-            oldest_entry = url_list.pop(0)
-            
-            # Blobストレージから古いコンテンツを削除
-            if oldest_entry.get('blob_url'):
-                run_async(blob_delete(oldest_entry['blob_url']))
-            
-            # ファイルも削除（後方互換性のため）
-            oldest_file = os.path.join(UPLOAD_FOLDER, f"{oldest_entry['id']}.html")
-            if os.path.exists(oldest_file):
-                try:
-                    os.remove(oldest_file)
-                except Exception as e:
-                    app.logger.error(f"古いファイルの削除エラー: {str(e)}")
-        
         # URLエントリの作成
         url_entry = {
             'id': file_id,
@@ -549,13 +1132,38 @@ def create():
             'full_url': full_url,
             'pixel_id': tiktok_pixel_id,
             'custom_code': pixel_code and '<script' in pixel_code,
-            'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'blob_url': blob_url
+            'created_at': now_str(),
+            'blob_url': blob_url,
+            'click_via_beacon': click_via_beacon
         }
         
-        url_list.append(url_entry)
+        with _url_list_update_lock:
+            # 外部ページの取得中に他の更新があり得るため、変更する直前にURLリストを読み直す
+            url_list = get_url_list_for_update()
+            
+            # 上限を超える場合は作成日時が最も古いエントリを一度の走査で特定してリストから外す
+            max_urls = config.get('max_urls', 100)
+            oldest_entry = None
+            if len(url_list) >= max_urls:
+                oldest_index = min(range(len(url_list)), key=lambda i: url_list[i].get('created_at', ''))
+                oldest_entry = url_list.pop(oldest_index)
+            
+            url_list.append(url_entry)
+            saved = save_url_list(url_list)
         
-        if save_url_list(url_list):
+        if saved:
+            # 新しいページとURLリストの保存に成功してから、新しいエントリの個別キーの保存と
+            # 古いエントリのKVの個別キー・Blobの削除を並行して行う
+            save_entry_and_evict_sync(url_entry, oldest_entry)
+            if oldest_entry is not None:
+                # 古いエントリのファイルも削除（後方互換性のため）
+                oldest_file = os.path.join(UPLOAD_FOLDER, f"{oldest_entry['id']}.html")
+                try:
+                    os.remove(oldest_file)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    app.logger.error(f"古いファイルの削除エラー: {str(e)}")
             flash('新しいURLが正常に作成されました！', 'success')
         else:
             flash('URLリストの保存中にエラーが発生しました。', 'error')
@@ -570,33 +1178,35 @@ def create():
 @app.route('/view/<file_id>')
 def view(file_id):
     try:
-        # URLリストから対象URLを検索
-        url_list = get_url_list()
-        target_url = None
-        
-        for url in url_list:
-            if url.get('id') == file_id:
-                target_url = url
-                break
+        # ID索引から対象URLを検索
+        target_url = get_url_entry(file_id)
         
         if not target_url:
             # URLが見つからない場合
             app.logger.info(f"URL not found: {file_id}")
-            return render_template('error.html', error="指定されたURLは存在しません"), 404
+            return error_response("指定されたURLは存在しません", 404)
         
         # HTMLコンテンツを取得（Blob優先）
         html_content = None
+        # Blobの内容はIDごとに不変なので、IDをETagとして使う
+        etag = file_id
+        last_modified = None
+        # ビーコン付きで作成したページはビーコンで数える
+        click_via_beacon = bool(target_url.get('click_via_beacon'))
         
         # 1. BlobストレージからHTMLコンテンツを取得
         if target_url.get('blob_url'):
+            if SERVE_BLOB_VIA_REDIRECT:
+                # ページはBlob側のオリジンで表示されビーコンが届かないため、ここで数える
+                record_click(file_id)
+                response = redirect(target_url['blob_url'], 302)
+                response.cache_control.no_cache = True
+                return response
+            
             app.logger.info(f"Blobストレージからコンテンツを取得: {target_url['blob_url']}")
             try:
                 if os.environ.get('BLOB_READ_WRITE_TOKEN'):
-                    coroutine = blob_get(target_url['blob_url'])
-                    if asyncio.iscoroutine(coroutine):
-                        html_content = run_async(coroutine)
-                    else:
-                        app.logger.error("blob_getがコルーチンを返しませんでした")
+                    html_content = get_blob_html(target_url['blob_url'])
                 else:
                     app.logger.error("BLOB_READ_WRITE_TOKENが設定されていません")
             except Exception as e:
@@ -607,108 +1217,99 @@ def view(file_id):
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id + '.html')
             app.logger.info(f"ファイルからコンテンツを取得: {file_path}")
             
-            if not os.path.exists(file_path):
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
                 app.logger.error(f"HTML file not found: {file_path}")
-                return render_template('error.html', error="ファイルが見つかりません"), 404
+                return error_response("ファイルが見つかりません", 404)
+            
+            mtime_ns = file_stat.st_mtime_ns
+            etag = f"{file_id}-{mtime_ns}"
+            last_modified = mtime_ns // 1_000_000_000
+            
+            # 大きなファイルは読み込みながら送信する（保存時にUTF-8で書き出し済み）
+            if file_stat.st_size >= STREAM_MIN_SIZE:
+                if not click_via_beacon:
+                    record_click(file_id)
+                
+                response = Response(iter_file_chunks(file_path), mimetype='text/html')
+                response.headers['Content-Type'] = 'text/html; charset=utf-8'
+                response.content_length = file_stat.st_size
+                set_view_cache_headers(response, etag, last_modified, click_via_beacon)
+                return response.make_conditional(request)
             
-            # ファイルからHTMLコンテンツを読み込み
+            # ファイルからHTMLコンテンツを読み込み（更新時刻が同じならキャッシュを使用）
             try:
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        html_content = f.read()
-                except UnicodeDecodeError:
-                    # UTF-8で読めない場合はバイナリモードで読み込み
-                    with open(file_path, 'rb') as f:
-                        raw_content = f.read()
-                    
-                    # エンコーディングを推測
-                    encodings = ['utf-8', 'shift_jis', 'euc-jp', 'cp932', 'iso-2022-jp']
-                    for encoding in encodings:
-                        try:
-                            html_content = raw_content.decode(encoding)
-                            app.logger.info(f"エンコーディング検出: {encoding}")
-                            break
-                        except UnicodeDecodeError:
-                            continue
-                    
-                    # どのエンコーディングでも読み込めなかった場合
-                    if not html_content:
-                        html_content = raw_content.decode('utf-8', errors='replace')
-                        app.logger.warning(f"不明なエンコーディング、置換モードで読み込み")
+                html_content = load_html_file(file_path, mtime_ns)
             except Exception as e:
                 app.logger.error(f"ファイル読み込みエラー: {str(e)}")
                 return render_template('error.html', error=f"コンテンツの読み込みに失敗しました: {str(e)}"), 500
         
         if not html_content:
-            return render_template('error.html', error="コンテンツの読み込みに失敗しました"), 500
+            return error_response("コンテンツの読み込みに失敗しました", 500)
         
-        # クリック数を更新
-        try:
-            update_click_count(file_id)
-        except Exception as e:
-            app.logger.error(f"クリック数更新エラー: {str(e)}")
-            # 更新失敗は無視する
+        # クリック数を更新（ビーコン付きのページはビーコンで数える）
+        if not click_via_beacon:
+            record_click(file_id)
         
         # レスポンスを返す
         response = make_response(html_content)
         response.headers['Content-Type'] = 'text/html; charset=utf-8'
-        return response
+        set_view_cache_headers(response, etag, last_modified, click_via_beacon)
+        response = response.make_conditional(request)
+        return compress_response(response, cache_key=etag)
         
     except Exception as e:
         app.logger.error(f"ファイル表示エラー: {str(e)}", exc_info=True)
-        return render_template('error.html', error="コンテンツの表示中にエラーが発生しました"), 500
+        return error_response("コンテンツの表示中にエラーが発生しました", 500)
+
+@app.route('/click/<file_id>', methods=['POST'])
+def click_beacon(file_id):
+    """ビーコン付きで作成した表示ページから送られるクリック計測"""
+    entry = get_url_entry(file_id)
+    # ビーコンを埋め込んでいないページへの送信は数えない（表示時に数えているため）
+    if entry and entry.get('click_via_beacon'):
+        record_click(file_id)
+    return '', 204
 
 @app.route('/delete/<file_id>', methods=['POST'])
 def delete(file_id):
     try:
-        url_list = get_url_list()
-        target_index = None
-        target_url = None
-        
-        for i, url in enumerate(url_list):
-            if url.get('id') == file_id:
-                target_index = i
-                target_url = url
-                break
-        
-        if target_index is not None:
-            # リストから削除
-            url_list.pop(target_index)
+        with _url_list_update_lock:
+            url_list, by_id = _load_url_list(fresh=True)
+            target_url = by_id.get(file_id)
             
-            # Blobストレージから削除
-            if target_url.get('blob_url'):
-                try:
-                    if os.environ.get('BLOB_READ_WRITE_TOKEN'):
-                        coroutine = blob_delete(target_url['blob_url'])
-                        if asyncio.iscoroutine(coroutine):
-                            blob_deleted = run_async(coroutine)
-                            app.logger.info(f"Blobストレージからファイルを削除: {target_url['blob_url']}, 結果: {blob_deleted}")
-                        else:
-                            app.logger.error("blob_deleteがコルーチンを返しませんでした")
-                    else:
-                        app.logger.error("BLOB_READ_WRITE_TOKENが設定されていません")
-                except Exception as e:
-                    app.logger.error(f"Blobストレージからの削除に失敗: {str(e)}")
+            if target_url is not None:
+                # リストから削除（共有のリストは変更せず、対象を除いた新しいリストを作る）
+                url_list = [url for url in url_list if url.get('id') != file_id]
             
-            # ファイルも削除（後方互換性のため）
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id + '.html')
-            if os.path.exists(file_path):
+                # KVの個別キーとBlobストレージから並行して削除
+                blob_url = target_url.get('blob_url')
+                if blob_url and not os.environ.get('BLOB_READ_WRITE_TOKEN'):
+                    app.logger.error("BLOB_READ_WRITE_TOKENが設定されていません")
+                delete_stored_content_sync(file_id, blob_url)
+                app.logger.info(f"保存済みコンテンツを削除: {file_id}")
+            
+                # ファイルも削除（後方互換性のため）
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_id + '.html')
                 try:
                     os.remove(file_path)
                     app.logger.info(f"ファイルシステムからファイルを削除: {file_path}")
+                except FileNotFoundError:
+                    pass
                 except Exception as e:
                     app.logger.error(f"ファイルシステムからの削除に失敗: {str(e)}")
                     # Vercel環境での削除エラーは無視
                     if os.environ.get('VERCEL') != '1':
                         flash(f'ファイル削除エラー: {str(e)}', 'warning')
             
-            # URLリストを保存
-            if save_url_list(url_list):
-                flash('URLが正常に削除されました', 'success')
+                # URLリストを保存
+                if save_url_list(url_list):
+                    flash('URLが正常に削除されました', 'success')
+                else:
+                    flash('URLリストの保存中にエラーが発生しました', 'error')
             else:
-                flash('URLリストの保存中にエラーが発生しました', 'error')
-        else:
-            flash('指定されたURLが見つかりません', 'error')
+                flash('指定されたURLが見つかりません', 'error')
             
         return redirect(url_for('index'))
         
@@ -767,11 +1368,11 @@ def admin_logout():
 
 @app.errorhandler(404)
 def page_not_found(e):
-    return render_template('error.html', error="ページが見つかりません"), 404
+    return error_response("ページが見つかりません", 404)
 
 @app.errorhandler(500)
 def server_error(e):
-    return render_template('error.html', error="サーバーエラーが発生しました"), 500
+    return error_response("サーバーエラーが発生しました", 500)
 
 # 診断用のエンドポイントを追加
 @app.route('/debug/env')
@@ -807,7 +1408,7 @@ def debug_env():
     # インストール済みのモジュール確認
     try:
         import pkg_resources
-        for package in ['vercel-kv', 'vercel-blob', 'flask']:
+        for package in ['vercel-kv', 'vercel-blob', 'flask', 'orjson']:
             try:
                 version = pkg_resources.get_distribution(package).version
                 env_info["modules"][package] = version
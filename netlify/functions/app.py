@@ -1,12 +1,30 @@
 from flask import Flask, render_template, request, redirect, url_for, flash
 import os
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from urllib3.util.retry import Retry
 import uuid
 import json
 from datetime import datetime
 from flask_serverless import FlaskServerless
 
+# JSONシリアライザ（orjsonが利用可能ならC実装を使用）
+try:
+    import orjson
+
+    def json_dumps_bytes(obj):
+        return orjson.dumps(obj)
+
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+
+    def json_dumps_bytes(obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    json_loads = json.loads
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev_key_for_testing')
 
@@ -18,19 +36,81 @@ if not os.path.exists(URLS_DIR):
 
 # URLリストのJSONファイル
 URL_LIST_FILE = os.path.join(URLS_DIR, 'url_list.json')
+
+def read_url_list():
+    """URLリストを読み込む（ファイルがない場合は空のリストを作成）"""
+    if not os.path.exists(URL_LIST_FILE):
+        write_url_list([])
+    with open(URL_LIST_FILE, 'rb') as f:
+        return json_loads(f.read())
+
+def write_url_list(url_list):
+    """URLリストを保存する"""
+    with open(URL_LIST_FILE, 'wb') as f:
+        f.write(json_dumps_bytes(url_list))
+
 if not os.path.exists(URL_LIST_FILE):
-    with open(URL_LIST_FILE, 'w') as f:
-        json.dump([], f)
+    write_url_list([])
+
+# TikTok Pixelスクリプトのテンプレート（モジュール読み込み時に一度だけ構築）
+# ピクセルIDはformatではなく目印の文字列を置換して埋め込む（JSの波括弧をエスケープせずに済む）
+PIXEL_ID_PLACEHOLDER = '__PIXEL_ID__'
+TIKTOK_PIXEL_TEMPLATE = '''
+<script>
+!function (w, d, t) {{
+  w.TiktokAnalyticsObject=t;var ttq=w[t]=w[t]||[];ttq.methods=["page","track","identify","instances","debug","on","off","once","ready","alias","group","enableCookie","disableCookie"],ttq.setAndDefer=function(t,e){{t[e]=function(){{t.push([e].concat(Array.prototype.slice.call(arguments,0)))}}}};for(var i=0;i<ttq.methods.length;i++)ttq.setAndDefer(ttq,ttq.methods[i]);ttq.instance=function(t){{for(var e=ttq._i[t]||[],n=0;n<ttq.methods.length;n++)ttq.setAndDefer(e,ttq.methods[n]);return e}},ttq.load=function(e,n){{var i="https://analytics.tiktok.com/i18n/pixel/events.js";ttq._i=ttq._i||{},ttq._i[e]=[],ttq._i[e]._u=i,ttq._t=ttq._t||{},ttq._t[e]=+new Date,ttq._o=ttq._o||{},ttq._o[e]=n||{};var o=document.createElement("script");o.type="text/javascript",o.async=!0,o.src=i+"?sdkid="+e+"&lib="+t;var a=document.getElementsByTagName("script")[0];a.parentNode.insertBefore(o,a)}};
+
+  ttq.load('__PIXEL_ID__');
+  ttq.page();
+}}(window, document, 'ttq');
+</script>
+'''
+
+# 外部ページの取得
+FETCH_CHUNK_SIZE = 64 * 1024
+MAX_FETCH_BYTES = 8 * 1024 * 1024  # 8MB制限
+
+# 外部ページ取得用のセッション（ウォームな実行環境では同じオリジンへの接続を再利用する）
+http_session = requests.Session()
+_fetch_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                      allowed_methods=['GET'], raise_on_status=False),
+)
+http_session.mount('http://', _fetch_adapter)
+http_session.mount('https://', _fetch_adapter)
+
+def fetch_html(url):
+    """URLからHTMLを取得する（ストリーミングで読み込み、上限サイズを超えた場合は中断）"""
+    with http_session.get(url, timeout=10, stream=True) as response:
+        response.raise_for_status()
+        
+        buf = bytearray()
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            buf.extend(chunk)
+            if len(buf) > MAX_FETCH_BYTES:
+                raise ValueError(f"ページサイズが上限({MAX_FETCH_BYTES // (1024 * 1024)}MB)を超えています")
+        
+        raw_content = bytes(buf)
+        # charsetが明示されている場合のみ信頼し、それ以外は内容から判定する
+        # （requestsはcharset未指定のtext/*にISO-8859-1を仮定する。読み込み済みのため
+        #   response.apparent_encodingは使えず、同じ判定器を直接呼ぶ）
+        content_type = response.headers.get('Content-Type', '').lower()
+        if response.encoding and 'charset=' in content_type:
+            encoding = response.encoding
+        else:
+            encoding = (chardet.detect(raw_content)['encoding'] if chardet else None) or 'utf-8'
+        try:
+            return raw_content.decode(encoding, errors='replace')
+        except LookupError:
+            # 不明なエンコーディング名が指定されていた場合
+            return raw_content.decode('utf-8', errors='replace')
 
 @app.route('/')
 def index():
     # 保存されたURLリストを取得
-    if not os.path.exists(URL_LIST_FILE):
-        with open(URL_LIST_FILE, 'w') as f:
-            json.dump([], f)
-    
-    with open(URL_LIST_FILE, 'r') as f:
-        url_list = json.load(f)
+    url_list = read_url_list()
     return render_template('index.html', url_list=url_list)
 
 @app.route('/create', methods=['POST'])
@@ -44,37 +124,20 @@ def create():
     
     try:
         # オリジナルURLからHTMLを取得
-        response = requests.get(original_url)
-        response.raise_for_status()
-        
-        # HTMLの解析
-        soup = BeautifulSoup(response.text, 'html.parser')
+        html_content = fetch_html(original_url)
         
         # TikTok Pixelスクリプトの作成
-        pixel_script = f'''
-<script>
-!function (w, d, t) {{{{
-  w.TiktokAnalyticsObject=t;var ttq=w[t]=w[t]||[];ttq.methods=["page","track","identify","instances","debug","on","off","once","ready","alias","group","enableCookie","disableCookie"],ttq.setAndDefer=function(t,e){{{{t[e]=function(){{{{t.push([e].concat(Array.prototype.slice.call(arguments,0)))}}}}}}}};for(var i=0;i<ttq.methods.length;i++)ttq.setAndDefer(ttq,ttq.methods[i]);ttq.instance=function(t){{{{for(var e=ttq._i[t]||[],n=0;n<ttq.methods.length;n++)ttq.setAndDefer(e,ttq.methods[n]);return e}}}},ttq.load=function(e,n){{{{var i="https://analytics.tiktok.com/i18n/pixel/events.js";ttq._i=ttq._i||{{}},ttq._i[e]=[],ttq._i[e]._u=i,ttq._t=ttq._t||{{}},ttq._t[e]=+new Date,ttq._o=ttq._o||{{}},ttq._o[e]=n||{{}};var o=document.createElement("script");o.type="text/javascript",o.async=!0,o.src=i+"?sdkid="+e+"&lib="+t;var a=document.getElementsByTagName("script")[0];a.parentNode.insertBefore(o,a)}}}};
-
-  ttq.load('{pixel_id}');
-  ttq.page();
-}}}}(window, document, 'ttq');
-</script>
-'''
+        pixel_script = TIKTOK_PIXEL_TEMPLATE.replace(PIXEL_ID_PLACEHOLDER, pixel_id)
         
-        # headタグがない場合は作成
-        if not soup.head:
-            head = soup.new_tag('head')
-            if soup.html:
-                soup.html.insert(0, head)
-            else:
-                html = soup.new_tag('html')
-                html.append(head)
-                soup.append(html)
-        
-        # Pixelスクリプトを挿入
-        new_script = BeautifulSoup(pixel_script, 'html.parser')
-        soup.head.append(new_script)
+        # HTMLにピクセルコードを挿入
+        head_closing_tag = '</head>'
+        if head_closing_tag in html_content:
+            # </head> の直前にピクセルコードを挿入
+            head_end_index = html_content.find(head_closing_tag)
+            new_html = html_content[:head_end_index] + pixel_script + html_content[head_end_index:]
+        else:
+            # <head>タグがない場合は先頭に挿入
+            new_html = pixel_script + html_content
         
         # 一意のファイル名を生成
         file_id = str(uuid.uuid4())
@@ -83,15 +146,10 @@ def create():
         
         # 修正したHTMLを保存
         with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(str(soup))
+            f.write(new_html)
         
         # URLリストに追加
-        if not os.path.exists(URL_LIST_FILE):
-            with open(URL_LIST_FILE, 'w') as f:
-                json.dump([], f)
-                
-        with open(URL_LIST_FILE, 'r') as f:
-            url_list = json.load(f)
+        url_list = read_url_list()
         
         # 本番環境のURLを取得
         if os.environ.get('URL'):
@@ -111,8 +169,7 @@ def create():
             'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
         
-        with open(URL_LIST_FILE, 'w') as f:
-            json.dump(url_list, f)
+        write_url_list(url_list)
         
         flash('新しいURLが正常に作成されました！', 'success')
         return redirect(url_for('index'))
@@ -142,13 +199,9 @@ def delete(file_id):
         os.remove(file_path)
     
     if os.path.exists(URL_LIST_FILE):
-        with open(URL_LIST_FILE, 'r') as f:
-            url_list = json.load(f)
-        
+        url_list = read_url_list()
         url_list = [url for url in url_list if url['id'] != file_id]
-        
-        with open(URL_LIST_FILE, 'w') as f:
-            json.dump(url_list, f)
+        write_url_list(url_list)
     
     flash('URLが正常に削除されました！', 'success')
     return redirect(url_for('index'))